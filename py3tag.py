@@ -4,21 +4,23 @@
 import os
 import sys
 import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
 import argparse
 import errno
 import glob
-from pathlib import Path
 from setuptools.namespaces import flatten
 import re
 import time
+import functools
+import struct
+
+# Prevent BLAS threads from oversubscribing the cores used by the pool, must be set before numpy is imported
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
 import audioread
 import numpy as np
 
-# Fix librosa deprecation issues with numpy
-np.complex = np.complex_
-np.float = float
-import librosa
-
 # Use mutagen for reading tags
 from mutagen.id3 import ID3, ID3NoHeaderError, PictureType, TPE1, TSOP, TPE2, TCOM, TALB, TSOA, TRCK, TIT2, TDRC, TCON, TBPM, TCMP, APIC, error
 from mutagen.flac import FLAC, Picture
@@ -59,6 +61,25 @@ __DRY_RUN__ = args.dryrun
 # BPM Detection
 __BPM_DISABLED__ = args.bpm_disabled
 
+# librosa and soundfile are heavy to import and only needed for BPM detection
+if (__BPM_DISABLED__ == False):
+	# Fix librosa deprecation issues with numpy
+	np.complex = np.complex_
+	np.float = float
+	import librosa
+	import soundfile
+
+# Length of audio excerpt in seconds that is used for BPM detection
+__BPM_WINDOW__ = 60.0
+
+# Spectrogram parameters for the onset envelope
+__N_FFT__ = 2048
+__HOP_LENGTH__ = 512
+__N_MELS__ = 128
+
+# Number of spectrogram frames per streamed block
+__BLOCK_LENGTH__ = 256
+
 # CPU Cores
 __CPU__ = args.cpu
 if (__CPU__) == 0: __CPU__ = multiprocessing.cpu_count()
@@ -66,6 +87,21 @@ if (__CPU__) == 0: __CPU__ = multiprocessing.cpu_count()
 # Default genre
 genre = args.genre
 
+# Supported audio file suffixes
+__AUDIO_EXTS__ = (".mp3", ".flac", ".m4a")
+
+# Total number of tracks per directory, set in each worker by init_worker()
+__DIR_TRACKS__ = {}
+
+# Shared block with the offsets and encoded names of all files, set in each worker by init_worker()
+__FILES_SHM__ = None
+
+# Precompiled regular expressions
+__DIR_RE__ = re.compile(r'.*/')
+__EXT_RE__ = re.compile(r'\..*')
+__PAREN_RE__ = re.compile(r'\((.*?)\)')
+__SPACE_RE__ = re.compile(r'.* ')
+
 
 
 # -------------------- Class: fragile --------------------
@@ -99,26 +135,97 @@ def WARNING(msg):
 
 
 
+# -------------------- Find audio files, optionally recursive --------------------
+def walk_audio(root, exts=__AUDIO_EXTS__, recursive=True):
+	try:
+		with os.scandir(root) as entries:
+			entries = list(entries)
+	except OSError:
+		WARNING("Warning: Could not read directory " + root + ".")
+		return
+	
+	for entry in entries:
+		if entry.is_dir(follow_symlinks=False):
+			if (recursive):
+				yield from walk_audio(entry.path, exts)
+		elif entry.name.endswith(exts):
+			yield entry.path
+
+
+
+# -------------------- Highest track number in directory for each track position --------------------
+def album_tracks(dirname, recursive=True):
+	tracks = {1: [], 2: []}
+	for i in walk_audio(dirname or os.curdir, recursive=recursive):
+		audio_dirinfo = os.path.basename(i).split(" - ")
+		for track_position in tracks:
+			if (len(audio_dirinfo) > track_position) and (audio_dirinfo[track_position].isdigit()):
+				tracks[track_position].append(int(audio_dirinfo[track_position]))
+	return {track_position: max(tracks[track_position]) for track_position in tracks if tracks[track_position]}
+
+
+
+# -------------------- Read Cover.jpg once per directory and worker lifetime --------------------
+@functools.lru_cache(maxsize=None)
+def read_cover(dirname):
+	# Files are sorted by directory and dispatched in contiguous chunks, so the cache only
+	# misses again where an album is split across chunks or a worker has been recycled
+	try:
+		with open(str(dirname + '/Cover.jpg'), 'rb') as f:
+			return f.read()
+	except OSError:
+		return None
+
+
+
+# -------------------- Initialize worker process --------------------
+def init_worker(dir_tracks, files_shm_name):
+	global __DIR_TRACKS__, __FILES_SHM__
+	
+	# Total number of tracks per directory, computed once in the main process
+	__DIR_TRACKS__ = dir_tracks
+	
+	# Attach to the shared list of file names so tasks only need to pass an index
+	__FILES_SHM__ = SharedMemory(name=files_shm_name)
+	
+	# Release the handle when the worker exits, atexit handlers do not run in pool workers
+	multiprocessing.util.Finalize(None, __FILES_SHM__.close, exitpriority=10)
+
+
+
 # -------------------- Load an audio buffer --------------------
-def audioread_load(path, offset, duration, dtype):
+def audioread_load(path, offset, duration, dtype, centered=False):
 	# using audioread (modified from librosa, originally ISC licensed)
-	y = []
 	with audioread.audio_open(path) as input_file:
 		sr_native = input_file.samplerate
 		n_channels = input_file.channels
+		
+		# Take the excerpt from the middle of the file, avoids opening the file again just for its duration
+		if (centered) and (duration is not None):
+			offset = max(0.0, input_file.duration / 2 - duration / 2)
+		
+		# Pre-allocate the raw 16-bit buffer from the reported duration plus one second of slack
+		if duration is None:
+			expected = max(0.0, input_file.duration - offset)
+		else:
+			expected = min(duration, max(0.0, input_file.duration - offset))
+		raw = np.empty((int(expected * sr_native) + sr_native) * n_channels, dtype='<i2')
+		pos = 0
 
-		s_start = int(np.round(sr_native * offset)) * n_channels
+		s_start = int(round(sr_native * offset)) * n_channels
 
+		# Keep the bounds as Python ints so the frame loop compares ints only
 		if duration is None:
-			s_end = np.inf
+			s_end = sys.maxsize
 		else:
-			s_end = s_start + (int(np.round(sr_native * duration))
+			s_end = s_start + (int(round(sr_native * duration))
 							   * n_channels)
 
 		n = 0
 
 		for frame in input_file:
-			frame = librosa.util.buf_to_float(frame, dtype=dtype)
+			# audioread always yields 16-bit little-endian signed samples
+			frame = np.frombuffer(frame, dtype='<i2')
 			n_prev = n
 			n = n + len(frame)
 
@@ -139,42 +246,94 @@ def audioread_load(path, offset, duration, dtype):
 				# beginning is in this frame
 				frame = frame[(s_start - n_prev):]
 
+			# Grow the buffer if the reported duration was too short
+			if pos + len(frame) > len(raw):
+				raw = np.resize(raw, max(2 * len(raw), pos + len(frame)))
+			
 			# tack on the current frame
-			y.append(frame)
+			np.copyto(raw[pos:pos + len(frame)], frame)
+			pos = pos + len(frame)
 		
-	if y:
-		y = np.concatenate(y)
-		
-		# For non-mono files, reduce to one channel
-		if n_channels > 1:
-			y = y.reshape((-1, n_channels)).T
-		
-		# Force an audio signal buffer down to mono by averaging samples across channels
-		if y.ndim > 1:
-			y = np.mean(y, axis=0)
-	else:
-		y = np.empty(0, dtype=dtype)
+	# Convert all samples to float in one pass
+	y = raw[:pos].astype(dtype)
+	y *= 1.0 / 32768.0
+	
+	# Force an audio signal buffer down to mono by averaging interleaved samples across channels
+	if n_channels > 1:
+		y = y.reshape((-1, n_channels)).mean(axis=1)
 
 	return y, sr_native
 
 
 
+# -------------------- Mel filter bank, built once per worker --------------------
+@functools.lru_cache(maxsize=None)
+def mel_basis(sr, n_fft, n_mels):
+	return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+
+
+
+# -------------------- Mel power spectrogram --------------------
+def mel_power(y, sr, center=True):
+	# Mel power spectrogram with the cached filter bank
+	S = np.abs(librosa.stft(y, n_fft=__N_FFT__, hop_length=__HOP_LENGTH__, center=center)) ** 2
+	return np.dot(mel_basis(sr, __N_FFT__, __N_MELS__), S)
+
+
+
+# -------------------- Onset strength envelope --------------------
+def onset_envelope(S, sr, center=True):
+	return librosa.onset.onset_strength(S=librosa.power_to_db(S, ref=np.max), sr=sr, hop_length=__HOP_LENGTH__, center=center)
+
+
+
 # -------------------- Count BPMs --------------------
 def bpm_count(audio_filename):
 	# Example from http://librosa.github.io/librosa/generated/librosa.beat.tempo.html
 	
-	# Convert using audioread
-	y, sr = audioread_load(path=audio_filename, offset=0.0, duration=None, dtype=np.float32)
+	audio_suffix = os.path.splitext(audio_filename)[1].lower()
+	
+	# Tempo is a global statistic, so only analyze a window from the middle of the track
+	if (audio_suffix == ".flac"):
+		# Read duration and sample rate with a single header read
+		info = soundfile.info(audio_filename)
+		offset = max(0.0, info.duration / 2 - __BPM_WINDOW__ / 2)
+		sr = info.samplerate
+		
+		# Stream blocks through libsndfile so the waveform is never fully materialized,
+		# only the mel spectrogram of the window is kept (about 2.6 MB for 60 seconds)
+		S = []
+		for block in librosa.stream(audio_filename, block_length=__BLOCK_LENGTH__, frame_length=__N_FFT__, hop_length=__HOP_LENGTH__,
+									mono=True, offset=offset, duration=__BPM_WINDOW__, dtype=np.float32):
+			# The last block may be shorter than a single frame
+			if (len(block) < __N_FFT__):
+				continue
+			S.append(mel_power(block, sr, center=False))
+		
+		if (len(S) == 0):
+			WARNING("Warning: " + audio_filename + " is too short for BPM detection.")
+			return(0.0)
+		
+		# Compute the onset envelope once over all blocks so block boundaries do not distort it
+		onset_env = onset_envelope(np.concatenate(S, axis=1), sr, center=False)
+	else:
+		# Fall back to audioread for mp3 and m4a
+		y, sr = audioread_load(path=audio_filename, offset=0.0, duration=__BPM_WINDOW__, dtype=np.float32, centered=True)
+		
+		if (len(y) < __N_FFT__):
+			WARNING("Warning: " + audio_filename + " is too short for BPM detection.")
+			return(0.0)
+		
+		onset_env = onset_envelope(mel_power(y, sr), sr)
 	
 	# Estimate a static tempo
-	onset_env = librosa.onset.onset_strength(y, sr=sr)
-	tempo = librosa.beat.tempo(onset_envelope=onset_env, sr=sr)
+	tempo = librosa.beat.tempo(onset_envelope=onset_env, sr=sr, hop_length=__HOP_LENGTH__)
 	return(float(tempo))
 
 
 
 # -------------------- Update mp3 tags --------------------
-def mp3_tag(mp3_dirname, mp3_filename, artist, album, track, tracks, title, year, genre, bpms, compilation):
+def mp3_tag(mp3_dirname, mp3_filename, cover, artist, album, track, tracks, title, year, genre, bpms, compilation):
 	# Delete existing tags
 	try:
 		id3 = ID3(mp3_filename)
@@ -182,51 +341,36 @@ def mp3_tag(mp3_dirname, mp3_filename, artist, album, track, tracks, title, year
 	except ID3NoHeaderError:
 		id3 = ID3()
 	
-	# Artist
-	id3.add(TPE1(encoding=3, text=artist))
-	
-	# Artistsort
-	id3.add(TSOP(encoding=3, text=artist))
-	
-	# Band
-	id3.add(TPE2(encoding=3, text=artist))
-	
-	# Composer
-	id3.add(TCOM(encoding=3, text=artist))
-	
-	# Album
-	id3.add(TALB(encoding=3, text=album))
-	
-	# Albumsort
-	id3.add(TSOA(encoding=3, text=album))
-	
-	# Track
-	id3.add(TRCK(encoding=3, text=tracks))
-	
-	# Title
-	id3.add(TIT2(encoding=3, text=title))
-	
-	# Year
-	id3.add(TDRC(encoding=3, text=year))
-	
-	# Genre
-	id3.add(TCON(encoding=3, text=genre))
-	
-	# BPMs
-	id3.add(TBPM(encoding=3, text=bpms))
-
-	# Compilation
-	if (compilation):
-		id3.add(TCMP(encoding=3, text='1'))
-	else:
-		id3.add(TCMP(encoding=3, text='0'))
+	# Build all text frames first and add them in one pass
+	frames = [
+		# Artist, Artistsort, Band, Composer
+		TPE1(encoding=3, text=artist),
+		TSOP(encoding=3, text=artist),
+		TPE2(encoding=3, text=artist),
+		TCOM(encoding=3, text=artist),
+		
+		# Album, Albumsort
+		TALB(encoding=3, text=album),
+		TSOA(encoding=3, text=album),
+		
+		# Track, Title, Year, Genre, BPMs
+		TRCK(encoding=3, text=tracks),
+		TIT2(encoding=3, text=title),
+		TDRC(encoding=3, text=year),
+		TCON(encoding=3, text=genre),
+		TBPM(encoding=3, text=bpms),
+		
+		# Compilation
+		TCMP(encoding=3, text='1' if (compilation) else '0'),
+	]
+	add = id3.add
+	for frame in frames:
+		add(frame)
 	
 	# Cover
-	image = str(mp3_dirname + '/Cover.jpg')
-	try:
-		imagefile = open(image, 'rb').read()
-		id3.add(APIC(3, 'image/jpeg', 3, 'Cover', imagefile))
-	except:
+	if (cover is not None):
+		id3.add(APIC(3, 'image/jpeg', 3, 'Cover', cover))
+	else:
 		WARNING("Warning. No Cover.jpg in directory " + mp3_dirname + ".")
 	
 	# Save tags to file
@@ -235,70 +379,69 @@ def mp3_tag(mp3_dirname, mp3_filename, artist, album, track, tracks, title, year
 
 
 # -------------------- Update flac tags --------------------
-def flac_tag(flac_dirname, flac_filename, artist, album, track, tracks, title, year, genre, bpms, compilation):
+def flac_tag(flac_dirname, flac_filename, cover, artist, album, track, tracks, title, year, genre, bpms, compilation):
 	# Delete existing tags
 	id3 = FLAC(flac_filename)
 	id3.clear_pictures()
 	id3.delete()
 	
-	# Artist, Composer
-	id3["ARTIST"] = artist
-	id3["ALBUM_ARTIST"] = artist
-	id3["ALBUMARTIST"] = artist
-	id3["COMPOSER"] = artist
-	
-	# Artistsort
-	id3["SORT_ARTIST"] = artist
-	id3["SORT_COMPOSER"] = artist
-	id3["SORT_ALBUM_ARTIST"] = artist
-	id3["ARTISTSORT"] = artist
-	id3["ALBUMARTISTSORT"] = artist
-	id3["COMPOSERSORT"] = artist
-	id3["soar"] = artist
-	id3["soaa"] = artist
-	id3["soco"] = artist
-	
-	# Album
-	id3["ALBUM"] = album
-	
-	# Albumsort
-	id3["SORT_ALBUM"] = album
-	id3["ALBUMSORT"] = album
-	
-	# Track
-	id3["TRACKNUMBER"] = tracks
-	id3["TRACK"] = tracks
-	id3["DISCNUMBER"] = '1/1'
-	
-	# Title
-	id3["TITLE"] = title
-	
-	# Year
-	id3["YEAR_OF_RELEASE"] = year
-	id3["DATE"] = year
-	
-	# Genre
-	id3["GENRE"] = genre
-	
-	# BPMs
-	id3["BPM"] = bpms
-	id3["tmpo"] = bpms
-
-	# Compilation
-	if (compilation):
-		id3["COMPILATION"] = '1'
-	else:
-		id3["COMPILATION"] = '0'
+	id3.update({
+		# Artist, Composer
+		"ARTIST": artist,
+		"ALBUM_ARTIST": artist,
+		"ALBUMARTIST": artist,
+		"COMPOSER": artist,
+		
+		# Artistsort
+		"SORT_ARTIST": artist,
+		"SORT_COMPOSER": artist,
+		"SORT_ALBUM_ARTIST": artist,
+		"ARTISTSORT": artist,
+		"ALBUMARTISTSORT": artist,
+		"COMPOSERSORT": artist,
+		"soar": artist,
+		"soaa": artist,
+		"soco": artist,
+		
+		# Album
+		"ALBUM": album,
+		
+		# Albumsort
+		"SORT_ALBUM": album,
+		"ALBUMSORT": album,
+		
+		# Track
+		"TRACKNUMBER": tracks,
+		"TRACK": tracks,
+		"DISCNUMBER": '1/1',
+		
+		# Title
+		"TITLE": title,
+		
+		# Year
+		"YEAR_OF_RELEASE": year,
+		"DATE": year,
+		
+		# Genre
+		"GENRE": genre,
+		
+		# BPMs
+		"BPM": bpms,
+		"tmpo": bpms,
+		
+		# Compilation
+		"COMPILATION": '1' if (compilation) else '0',
+	})
 	
 	# Cover
 	id3.clear_pictures()
-	try:
+	if (cover is not None):
 		image = Picture()
-		image.data = open(str(flac_dirname + '/Cover.jpg'), 'rb').read()
+		image.data = cover
 		image.type = PictureType.COVER_FRONT
 		image.mime = "image/jpeg"
 		id3.add_picture(image)
-	except:
+	else:
 		WARNING("Warning. No Cover.jpg in directory " + flac_dirname + ".")
 	
 	# Save tags to file
@@ -307,7 +450,7 @@ def flac_tag(flac_dirname, flac_filename, artist, album, track, tracks, title, y
 
 
 # -------------------- Update m4a tags --------------------
-def m4a_tag(m4a_dirname, m4a_filename, artist, album, track, tracks, title, year, genre, bpms, compilation):
+def m4a_tag(m4a_dirname, m4a_filename, cover, artist, album, track, max_track, title, year, genre, bpms, compilation):
 	# Print tags first
 	#m4a = MP4(m4a_filename)
 	#print(m4a.pprint())
@@ -316,51 +459,49 @@ def m4a_tag(m4a_dirname, m4a_filename, artist, album, track, tracks, title, year
 	id3 = MP4Tags()
 	id3.delete(m4a_filename)
 	
-	# Artist, Composer
-	id3['\xa9ART'] = artist
-	id3['aART'] = artist
-	id3['\xa9wrt'] = artist
-	
-	# Artistsort
-	id3['soaa'] = artist
-	id3['soar'] = artist
-	id3['soco'] = artist
-	
-	# Album
-	id3['\xa9alb'] = album
-	
-	# Albumsort
-	id3['soal'] = album
-	
-	# Track
-	id3['trkn'] = [(int(track), int(re.sub(pattern='.*\/', repl='', string=tracks)))]
-	id3['disk'] = [(1, 1)]
-	
-	# Title
-	id3['\xa9nam'] = title
-	id3['sonm'] = title
-	
-	# Year
-	id3['\xa9day'] = year
-	
-	# Genre
-	id3['\xa9gen'] = genre
-	
-	# BPMs, Gapless album
-	id3['tmpo'] = [(int(round(float(bpms), 0)))]
-	id3['pgap'] = True
-
-	# Compilation
-	if (compilation):
-		id3['cpil'] = True
-	else:
-		id3['cpil'] = False
+	id3.update({
+		# Artist, Composer
+		'\xa9ART': artist,
+		'aART': artist,
+		'\xa9wrt': artist,
+		
+		# Artistsort
+		'soaa': artist,
+		'soar': artist,
+		'soco': artist,
+		
+		# Album
+		'\xa9alb': album,
+		
+		# Albumsort
+		'soal': album,
+		
+		# Track
+		'trkn': [(track, max_track)],
+		'disk': [(1, 1)],
+		
+		# Title
+		'\xa9nam': title,
+		'sonm': title,
+		
+		# Year
+		'\xa9day': year,
+		
+		# Genre
+		'\xa9gen': genre,
+		
+		# BPMs, Gapless album
+		'tmpo': [(int(round(float(bpms), 0)))],
+		'pgap': True,
+		
+		# Compilation
+		'cpil': bool(compilation),
+	})
 	
 	# Cover
-	try:
-		with open(str(m4a_dirname + '/Cover.jpg'), 'rb') as f:
-			id3["covr"] = [ MP4Cover(f.read(), imageformat=MP4Cover.FORMAT_JPEG) ]
-	except:
+	if (cover is not None):
+		id3["covr"] = [ MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG) ]
+	else:
 		WARNING("Warning. No Cover.jpg in directory " + m4a_dirname + ".")
 	
 	# Save tags to file
@@ -372,102 +513,128 @@ def m4a_tag(m4a_dirname, m4a_filename, artist, album, track, tracks, title, year
 def process_audio(audio_filename):
 	audio_basename = os.path.basename(audio_filename)
 	audio_dirname = os.path.dirname(audio_filename)
-	audio_suffix = re.sub(pattern='.*\.', repl='', string=str(audio_filename))
+	audio_suffix = os.path.splitext(audio_filename)[1][1:].lower()
+	
+	# Bind global settings to locals
+	_DEBUG = __DEBUG__
+	_DRY_RUN = __DRY_RUN__
+	_BPM_DISABLED = __BPM_DISABLED__
 	
-	with audioread.audio_open(audio_filename) as f:
-		# Test audio file
-		if (__DEBUG__): print('\nFile: %s' %(audio_filename))
-		if (__DEBUG__): print('Info: %i channels, %i Hz, %.1f seconds.' %(f.channels, f.samplerate, f.duration))
-		f.close()
+	# A quiet dry-run only prints file names, so do not open or decode the audio file
+	if (_DRY_RUN) and (not _DEBUG):
+		bpms = "0"
+	else:
+		with audioread.audio_open(audio_filename) as f:
+			# Test audio file
+			if (_DEBUG): print('\nFile: %s' %(audio_filename))
+			if (_DEBUG): print('Info: %i channels, %i Hz, %.1f seconds.' %(f.channels, f.samplerate, f.duration))
 		
 		# Count BPM
-		if (__BPM_DISABLED__ == False):
+		if (_BPM_DISABLED == False):
 			# Convert audio to WAV
 			bpms = bpm_count(audio_filename)
 			bpms = str(round(bpms, 3))
 		else:
 			bpms = "0";
+	
+	# Update audio tags
+	audio_info = audio_basename.split(" - ")
+	if (len(audio_info) == 4):
+		# Remove unwanted characters
+		audio_info[0] = __DIR_RE__.sub('', audio_info[0])
+		audio_info[-1] = __EXT_RE__.sub('', audio_info[-1])
 		
-		# Update audio tags
-		audio_info = audio_basename.split(" - ")
-		if (len(audio_info) == 4):
-			# Remove unwanted characters
-			audio_info[0] = re.sub(pattern='.*/', repl='', string=audio_info[0])
-			audio_info[-1] = re.sub(pattern='\..*', repl='', string=audio_info[-1])
-			
-			# Determine track number
-			track = False
-			for i in range(0, len(audio_info)):
-				if ((audio_info[i].isdigit()) and ((len(audio_info[i])==2) or (len(audio_info[i])==3)) and (i != 0)):
-					track = audio_info[i]
-					break
-			if (track == False):
-				ERROR("Error: Track number in " + audio_filename + " could not be identified.")
-				raise fragile.Break
-			
-			# Structure: Artist - Album - Track - Title
-			if (audio_info.index(track) == 2):
-				track_position = 2
-				artist = audio_info[0]
-				album = audio_info[1]
-				title = audio_info[3]
-				compilation = False
-			# Structure: Compilation - Track - Artist - Title
-			elif (audio_info.index(track) == 1):
-				track_position = 1
-				album = audio_info[0]
-				artist = audio_info[2]
-				title = audio_info[3]
-				compilation = True
-			else:
-				ERROR("Error: Position of track " + audio_info.index(track) + " in " + audio_filename + " could not be identified.")
-				raise fragile.Break
-			
-			# Get number of total tracks in path
-			tracks = []
-			audio_dirfiles = sorted(filter(lambda p: p.suffix in {".mp3", ".flac", ".m4a"}, Path(audio_dirname).glob("**/*")))
-			for i in audio_dirfiles:
-				audio_dirfile = os.path.basename(i)
-				audio_dirinfo = audio_dirfile.split(" - ")
-				tracks.append(audio_dirinfo[track_position])
-			tracks = str(track + '/' + max(tracks))
-			
-			# Determine publication date (year)
-			try:
-				year = re.findall('\((.*?)\)', audio_dirname)
-				year = re.sub(r'.* ', '', year[-1])
-			except:
-				WARNING("Warning: Could not extract year information from " + audio_filename + ". Setting to current year.")
-				year = time.strftime("%Y")
-			
-			# Print out tags
-			if (__DEBUG__):
-				print("Artist: %s" %(artist))
-				print("Album: %s" %(album))
-				print("Tracks: %s" %(tracks))
-				print("Title: %s" %(title))
-				print("Year: %s" %(year))
-				print("Genre: %s" %(genre))
-				print("BPMs: %s" %(bpms))
-				print("Compilation: %s" %(compilation))
-			else:
-				print(audio_basename)
-			
-			# Write tags to audio file
-			if (__DRY_RUN__ == False):
-				try:
-					if (audio_suffix == "mp3"):
-						mp3_tag(audio_dirname, audio_filename, artist, album, track, tracks, title, year, genre, bpms, compilation)
-					elif (audio_suffix == "flac"):
-						flac_tag(audio_dirname, audio_filename, artist, album, track, tracks, title, year, genre, bpms, compilation)
-					elif (audio_suffix == "m4a"):
-						m4a_tag(audio_dirname, audio_filename, artist, album, track, tracks, title, year, genre, bpms, compilation)
-				except:
-					ERROR("Error: Failed to write tags to " + audio_filename + ".")
-					raise fragile.Break
+		# Determine track number
+		track = False
+		for i in range(0, len(audio_info)):
+			if ((audio_info[i].isdigit()) and ((len(audio_info[i])==2) or (len(audio_info[i])==3)) and (i != 0)):
+				track = audio_info[i]
+				break
+		if (track == False):
+			ERROR("Error: Track number in " + audio_filename + " could not be identified.")
+			raise fragile.Break
+		
+		# Structure: Artist - Album - Track - Title
+		if (audio_info.index(track) == 2):
+			track_position = 2
+			artist = audio_info[0]
+			album = audio_info[1]
+			title = audio_info[3]
+			compilation = False
+		# Structure: Compilation - Track - Artist - Title
+		elif (audio_info.index(track) == 1):
+			track_position = 1
+			album = audio_info[0]
+			artist = audio_info[2]
+			title = audio_info[3]
+			compilation = True
 		else:
-			ERROR("Error: Names for tags in file " + audio_filename + " could not be detected.")
+			ERROR("Error: Position of track " + audio_info.index(track) + " in " + audio_filename + " could not be identified.")
 			raise fragile.Break
+		
+		# Get number of total tracks in path
+		max_track = __DIR_TRACKS__[audio_dirname][track_position]
+		tracks = f"{track}/{max_track:0{len(track)}d}"
+		
+		# Determine publication date (year)
+		try:
+			year = __PAREN_RE__.findall(audio_dirname)
+			year = __SPACE_RE__.sub('', year[-1])
+		except:
+			WARNING("Warning: Could not extract year information from " + audio_filename + ". Setting to current year.")
+			year = time.strftime("%Y")
+		
+		# Print out tags
+		if (_DEBUG):
+			print("Artist: %s" %(artist))
+			print("Album: %s" %(album))
+			print("Tracks: %s" %(tracks))
+			print("Title: %s" %(title))
+			print("Year: %s" %(year))
+			print("Genre: %s" %(genre))
+			print("BPMs: %s" %(bpms))
+			print("Compilation: %s" %(compilation))
+		else:
+			print(audio_basename)
+		
+		# Write tags to audio file
+		if (_DRY_RUN == False):
+			cover = read_cover(audio_dirname)
+			try:
+				if (audio_suffix == "mp3"):
+					mp3_tag(audio_dirname, audio_filename, cover, artist, album, track, tracks, title, year, genre, bpms, compilation)
+				elif (audio_suffix == "flac"):
+					flac_tag(audio_dirname, audio_filename, cover, artist, album, track, tracks, title, year, genre, bpms, compilation)
+				elif (audio_suffix == "m4a"):
+					m4a_tag(audio_dirname, audio_filename, cover, artist, album, int(track), max_track, title, year, genre, bpms, compilation)
+			except:
+				ERROR("Error: Failed to write tags to " + audio_filename + ".")
+				raise fragile.Break
+	else:
+		ERROR("Error: Names for tags in file " + audio_filename + " could not be detected.")
+		raise fragile.Break
+
+
+
+# -------------------- Process audio file by index into the shared file list --------------------
+def process_index(index):
+	# The block starts with the int64 byte offsets of all names, followed by the names
+	start, end = struct.unpack_from('<2q', __FILES_SHM__.buf, 8 * index)
+	audio_filename = os.fsdecode(bytes(__FILES_SHM__.buf[start:end]))
+	process_audio(audio_filename)
+
+
+
+# -------------------- Process audio file by index and return errors to the main process --------------------
+def process_task(index):
+	try:
+		process_index(index)
+	except fragile.Break:
+		# Error has already been reported by the worker
+		pass
+	except Exception as e:
+		return (index, "%s: %s" %(type(e).__name__, e))
+	return (index, None)
 
 
 
@@ -477,18 +644,45 @@ if __name__ == "__main__" :
 	files = list(flatten(args.files))
 	
 	audio_files = []
+	walked_dirs = set()
 	
 	for i in files:
-		audio_files.extend(sorted(filter(lambda p: p.suffix in {".mp3", ".flac", ".m4a"}, Path(i).glob("**/*"))))
-	audio_files = [str(Path(i)) for i in audio_files]
+		if os.path.isdir(i):
+			walked = [os.path.normpath(j) for j in sorted(walk_audio(i))]
+			audio_files.extend(walked)
+			walked_dirs.update(os.path.dirname(j) for j in walked)
+		elif (os.path.isfile(i)) and (i.endswith(__AUDIO_EXTS__)):
+			audio_files.append(os.path.normpath(i))
+	
+	# Get number of total tracks once per directory
+	dir_tracks = {}
+	for i in audio_files:
+		audio_dirname = os.path.dirname(i)
+		if (audio_dirname not in dir_tracks):
+			# Only list the own directory of files given on the command line
+			dir_tracks[audio_dirname] = album_tracks(audio_dirname, recursive=(audio_dirname in walked_dirs))
 	
 	# Multiprocessing
 	if (__DEBUG__): print(f'Number of cores: {__CPU__}')
 	
-	# Process audio files
-	pool = multiprocessing.Pool(processes=__CPU__)
-	pool.map(func=process_audio, iterable=audio_files, chunksize=1)
-	pool.close()
-	pool.join()
+	# Put all file names into shared memory so the chunked tasks below only pickle indices
+	files_names = [os.fsencode(i) for i in audio_files]
+	files_offsets = [8 * (len(files_names) + 1)]
+	for i in files_names:
+		files_offsets.append(files_offsets[-1] + len(i))
+	files_shm = SharedMemory(create=True, size=files_offsets[-1])
+	struct.pack_into('<%iq' %(len(files_offsets)), files_shm.buf, 0, *files_offsets)
+	files_shm.buf[files_offsets[0]:files_offsets[-1]] = b''.join(files_names)
+	
+	# Process audio files in chunks of indices, recycle workers after 16 chunks to release librosa working sets
+	chunksize = max(1, len(audio_files) // (4 * __CPU__))
+	try:
+		with multiprocessing.Pool(processes=__CPU__, maxtasksperchild=16, initializer=init_worker, initargs=(dir_tracks, files_shm.name)) as pool:
+			for index, message in pool.imap_unordered(process_task, range(len(audio_files)), chunksize=chunksize):
+				if (message is not None):
+					ERROR("Error: Failed to process " + audio_files[index] + ": " + message)
+	finally:
+		files_shm.close()
+		files_shm.unlink()
 
 